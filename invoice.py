@@ -1,13 +1,19 @@
 import streamlit as st
-from PIL import Image
-import pandas as pd
-import json
-import asyncio
-from google import genai
-import tempfile
-import os
-from pypdf import PdfReader
-import fitz  # PyMuPDF
+import orjson
+from invoice_core import (
+    decode,
+    extract_cached,
+    extract_pdfs_cached,
+    gemini_model,
+    get_genai_client,
+    invoice_panel,
+    parse_json,
+    pdf_to_text_and_images,
+    prompt_part,
+    response_text,
+    run,
+    show_pdf_preview,
+)
 
 # Set page config
 st.set_page_config(page_title="Invoice Extractor", layout="wide")
@@ -54,34 +60,18 @@ Expected JSON response:
 """
 
 
-def pdf_to_images(path):
-    images = []
-    with fitz.open(path) as pdf:
-        for page in pdf:
-            pix = page.get_pixmap(dpi=150)  # higher DPI = better quality
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            images.append(img)
-    return images
-
-
-# Load Google API key from Streamlit secrets
-google_api_key = st.secrets["api_keys"]["google"]
-
-
 async def extract_info_from_text(prompt, text):
-    google_client = genai.Client(api_key=google_api_key)
-    response = google_client.models.generate_content(
-        model="gemini-2.0-flash-lite", contents=[prompt, text]
+    google_client = get_genai_client()
+    response = await google_client.aio.models.generate_content(
+        model=gemini_model, contents=[prompt_part(prompt), text]
     )
     return response
 
 
-async def extract_info_from_image(prompt, image):
-    google_client = genai.Client(api_key=google_api_key)
-    response = google_client.models.generate_content(
-        model="gemini-2.0-flash-lite", contents=[prompt, image]
-    )
-    return response
+@st.cache_data(show_spinner=False)
+def extract_text_cached(text, prompt=invoice_extraction_prompt):
+    # Keyed on the PDF text, so edits in the tables don't repeat the model call
+    return response_text(run(extract_info_from_text(prompt, text)))
 
 
 # Sidebar: Upload image
@@ -91,132 +81,62 @@ uploaded_file = st.sidebar.file_uploader(
 )
 
 if uploaded_file:
-    # Create a temporary file to store the uploaded file
-    with tempfile.NamedTemporaryFile(
-        delete=False, suffix=os.path.splitext(uploaded_file.name)[1]
-    ) as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        tmp_file_path = tmp_file.name
-
-    try:
-        # Display layout
-        col1, col2 = st.columns(2)
-
-        # Handle PDF files
-        if uploaded_file.type == "application/pdf":
-            # Extract text from PDF
-            pdf_reader = PdfReader(tmp_file_path)
-            text_content = ""
-            # Get text from first page only
-            if len(pdf_reader.pages) > 0:
-                text_content = pdf_reader.pages[0].extract_text()
-
-            with col1:
-                st.subheader("PDF Preview")
-                images = pdf_to_images(tmp_file_path)
-                for img in images:
-                    st.image(img, use_container_width=True)
-
-            # Send to Gemini
-            with st.spinner("Extracting invoice data..."):
-                try:
-                    response = asyncio.run(
-                        extract_info_from_text(invoice_extraction_prompt, text_content)
+    # Display layout
+    col1, col2 = st.columns(2)
+
+    # Handle PDF files
+    if uploaded_file.type == "application/pdf":
+        # First-page text, and a preview of every page unless scanned
+        text_content, images = pdf_to_text_and_images(uploaded_file.getvalue())
+
+        with col1:
+            st.subheader("PDF Preview")
+            show_pdf_preview(text_content, images)
+
+        # Send to Gemini
+        with st.spinner("Extracting invoice data..."):
+            try:
+                if text_content.strip():
+                    info_text = extract_text_cached(text_content)
+                else:
+                    # Scanned PDFs have no text layer, so Gemini reads the
+                    # document itself
+                    info_text = extract_pdfs_cached(
+                        (uploaded_file.getvalue(),), invoice_extraction_prompt
                     )
-                    info_text = response.text
-
-                    try:
-                        json_start = info_text.find("{")
-                        json_end = info_text.rfind("}") + 1
-                        info_formatted = json.loads(info_text[json_start:json_end])
-
-                        with col2:
-                            st.subheader("Extracted Invoice Data")
-
-                            # Extract line_items if present
-                            line_items = info_formatted.pop("line_items", [])
-
-                            # Display other fields as a table (key-value pairs)
-                            summary_df = pd.DataFrame(
-                                info_formatted.items(), columns=["Field", "Value"]
-                            )
-                            edited_summary_df = st.data_editor(
-                                summary_df,
-                                use_container_width=True,
-                                num_rows="dynamic",
-                                key="summary_editor",
-                            )
-
-                            # Display line items if any
-                            if line_items:
-                                st.subheader("Line Items")
-                                line_items_df = pd.DataFrame(line_items)
-                                edited_line_items_df = st.data_editor(
-                                    line_items_df,
-                                    use_container_width=True,
-                                    num_rows="dynamic",
-                                    key="line_items_editor",
-                                )
-                    except json.JSONDecodeError:
-                        st.error("Could not parse valid JSON from model output.")
-                except Exception as e:
-                    st.error(f"Model failed to extract info: {e}")
-
-        else:
-            # Handle regular image files
-            image = Image.open(uploaded_file)
-
-            # Show uploaded image
-            with col1:
-                st.subheader("Invoice Image")
-                st.image(image, use_container_width=True)
-
-            # Send to Gemini
-            with st.spinner("Extracting invoice data..."):
+
                 try:
-                    response = asyncio.run(
-                        extract_info_from_image(invoice_extraction_prompt, image)
-                    )
-                    info_text = response.text
-
-                    try:
-                        json_start = info_text.find("{")
-                        json_end = info_text.rfind("}") + 1
-                        info_formatted = json.loads(info_text[json_start:json_end])
-
-                        with col2:
-                            st.subheader("Extracted Invoice Data")
-
-                            # Extract line_items if present
-                            line_items = info_formatted.pop("line_items", [])
-
-                            # Display other fields as a table (key-value pairs)
-                            summary_df = pd.DataFrame(
-                                info_formatted.items(), columns=["Field", "Value"]
-                            )
-                            edited_summary_df = st.data_editor(
-                                summary_df,
-                                use_container_width=True,
-                                num_rows="dynamic",
-                                key="summary_editor",
-                            )
-
-                            # Display line items if any
-                            if line_items:
-                                st.subheader("Line Items")
-                                line_items_df = pd.DataFrame(line_items)
-                                edited_line_items_df = st.data_editor(
-                                    line_items_df,
-                                    use_container_width=True,
-                                    num_rows="dynamic",
-                                    key="line_items_editor",
-                                )
-                    except json.JSONDecodeError:
-                        st.error("Could not parse valid JSON from model output.")
-                except Exception as e:
-                    st.error(f"Model failed to extract info: {e}")
-
-    finally:
-        # Clean up temporary file
-        if os.path.exists(tmp_file_path):
-            os.unlink(tmp_file_path)
+                    info_formatted = parse_json(info_text)
+
+                    with col2:
+                        invoice_panel(info_formatted)
+                except orjson.JSONDecodeError:
+                    st.error("Could not parse valid JSON from model output.")
+            except Exception as e:
+                st.error(f"Model failed to extract info: {e}")
+
+    else:
+        # Handle regular image files
+        image = decode(uploaded_file.getvalue())
+
+        # Show uploaded image
+        with col1:
+            st.subheader("Invoice Image")
+            st.image(image, use_container_width=True, output_format="JPEG")
+
+        # Send to Gemini
+        with st.spinner("Extracting invoice data..."):
+            try:
+                info_text = extract_cached(
+                    uploaded_file.getvalue(), invoice_extraction_prompt
+                )
+
+                try:
+                    info_formatted = parse_json(info_text)
+
+                    with col2:
+                        invoice_panel(info_formatted)
+                except orjson.JSONDecodeError:
+                    st.error("Could not parse valid JSON from model output.")
+            except Exception as e:
+                st.error(f"Model failed to extract info: {e}")
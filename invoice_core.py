@@ -0,0 +1,389 @@
+# Extraction helpers shared by the invoice Streamlit apps
+import streamlit as st
+import pandas as pd
+from PIL import Image
+import orjson
+import json
+import re
+import asyncio
+import threading
+import io
+import hashlib
+import functools
+import sqlite3
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import fitz  # PyMuPDF
+from google import genai
+from google.genai import errors
+from google.genai import types
+
+gemini_model = "gemini-2.0-flash-lite"
+
+# Prompt for invoice extraction
+invoice_extraction_prompt = """
+You are an expert in document understanding and structured data extraction from financial documents like invoices.
+
+Below is an image of an invoice.
+
+Your task is to extract the following key fields from the invoice and return the result in a valid JSON format. If any information is not available in the invoice, return its value as `null`.
+
+Ensure all string values are clean and trimmed of unnecessary whitespace.
+
+Expected JSON response:
+{
+  "invoice_date": "YYYY-MM-DD or null",
+  "supplier_invoice_number": "string or null",
+  "customer_name": "string or null",
+  "supplier_name": "string or null",
+  "supplier_address": "string or null",
+  "customer_address": "string or null",
+  "total_amount": "string or null",
+  "tax_amount": "string or null",
+  "currency": "string or null",
+  "line_items": [
+    {
+      "description": "string or null",
+      "quantity": "string or null",
+      "unit_price": "string or null",
+      "total_price": "string or null"
+    }
+  ]
+}
+"""
+
+# Line item columns, in the order the prompt asks for them
+line_item_columns = ("description", "quantity", "unit_price", "total_price")
+
+# MIME types Gemini accepts, by PIL format. PIL reads many phone JPEGs as MPO,
+# which Gemini would reject as image/mpo.
+image_mime_types = {
+    "JPEG": "image/jpeg",
+    "MPO": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+# Attempts per request before a rate-limit error is reported
+max_retries = 5
+
+
+@st.cache_resource
+def get_render_pool():
+    # PyMuPDF isn't thread-safe, so pages are rendered in worker processes,
+    # spawned rather than forked from the multithreaded Streamlit server
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+
+
+# Below this many pages, starting worker processes and copying the PDF to
+# each costs more than rendering in the script thread
+parallel_render_pages = 50
+
+
+def render_pages(pdf, start, stop, dpi):
+    # Pages come back JPEG-encoded, which st.image takes as is, and blank
+    # pages (no text, images or vector drawings) as None instead of being
+    # rendered
+    images = []
+    zoom = fitz.Matrix(dpi / 72, dpi / 72)  # built once, not per page from dpi
+    for page in pdf.pages(start, stop):
+        if (
+            not page.get_text("text").strip()
+            and not page.get_images()
+            and not page.get_drawings()
+        ):
+            images.append(None)
+            continue
+        pix = page.get_pixmap(matrix=zoom, colorspace=fitz.csRGB, alpha=False)
+        images.append(pix.tobytes("jpeg", jpg_quality=85))
+    return images
+
+
+def render_page_range(pdf_bytes, start, stop, dpi):
+    # Worker process entry point; documents can't be shared across processes
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        return render_pages(pdf, start, stop, dpi)
+
+
+@st.cache_data(show_spinner=False)
+def pdf_to_text_and_images(pdf_bytes, dpi=72):
+    # First-page text and every page rendered. The renders are only previews,
+    # as Gemini gets the PDF itself, so a low DPI is enough.
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        text = pdf[0].get_text("text") if len(pdf) > 0 else ""
+        page_count = len(pdf)
+
+        # Scanned PDFs have no text layer and are the costliest to rasterise,
+        # so they get no preview
+        if not text.strip():
+            return text, []
+
+        workers = min(os.cpu_count() or 1, page_count)
+        if workers <= 1 or page_count < parallel_render_pages:
+            return text, render_pages(pdf, 0, page_count, dpi)
+
+    # One contiguous run of pages per worker, rendered in parallel
+    bounds = [page_count * i // workers for i in range(workers + 1)]
+    chunks = get_render_pool().map(
+        render_page_range, repeat(pdf_bytes), bounds[:-1], bounds[1:], repeat(dpi)
+    )
+    return text, [image for chunk in chunks for image in chunk]
+
+
+def show_pdf_preview(text, images):
+    if not text.strip():
+        st.info("Scanned PDF, preview skipped")
+    # All rendered pages in one st.image call, blank ones listed instead
+    rendered = [img for img in images if img is not None]
+    blank = [str(n) for n, img in enumerate(images, 1) if img is None]
+    if rendered:
+        st.image(rendered, use_container_width=True)
+    if blank:
+        st.caption(f"Blank pages: {', '.join(blank)}")
+
+
+@st.fragment
+def invoice_panel(info_formatted, columns=None):
+    # Edits in the tables rerun only this panel, not the whole script
+    st.subheader("Extracted Invoice Data")
+
+    # Extract line_items if present, leaving the caller's dict intact for
+    # fragment reruns
+    info_formatted = dict(info_formatted)
+    line_items = info_formatted.pop("line_items", [])
+
+    # Display other fields as a table (key-value pairs)
+    summary_df = pd.DataFrame.from_records(
+        list(info_formatted.items()), columns=("Field", "Value")
+    ).astype("string[pyarrow]")
+    st.data_editor(
+        summary_df,
+        use_container_width=True,
+        num_rows="dynamic",
+        key="summary_editor",
+    )
+
+    # Display line items if any; columns default to the prompt's own schema
+    if line_items:
+        st.subheader("Line Items")
+        line_items_df = pd.DataFrame.from_records(line_items, columns=columns).astype(
+            "string[pyarrow]"
+        )
+        st.data_editor(
+            line_items_df,
+            use_container_width=True,
+            num_rows="dynamic",
+            key="line_items_editor",
+        )
+
+
+def preprocess(image):
+    # Invoices stay legible at 1024px; larger scans only bloat the upload
+    image.thumbnail((1024, 1024), Image.LANCZOS)
+    return image
+
+
+@st.cache_resource
+def get_event_loop():
+    # One loop per process, running in its own thread, so reruns don't pay
+    # for a fresh loop and async clients stay bound to the loop they started on
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def submit(coro):
+    # Starts coro on the shared loop and returns a future without waiting on it
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+def run(coro):
+    return submit(coro).result()
+
+
+@st.cache_data(show_spinner=False)
+def decode(file_bytes):
+    # Decoded once per upload instead of on every rerun
+    return preprocess(Image.open(io.BytesIO(file_bytes)))
+
+
+@st.cache_data(show_spinner=False)
+def image_part(file_bytes):
+    # The upload's own bytes if already small enough and in a format Gemini
+    # takes, else the downscaled image encoded once as JPEG; a PIL image would
+    # be re-encoded to PNG per request
+    image = Image.open(io.BytesIO(file_bytes))
+    if max(image.size) <= 1024 and image.format in image_mime_types:
+        return types.Part.from_bytes(
+            data=file_bytes, mime_type=image_mime_types[image.format]
+        )
+    buf = io.BytesIO()
+    preprocess(image).convert("RGB").save(buf, "JPEG", quality=90)
+    return types.Part.from_bytes(data=buf.getvalue(), mime_type="image/jpeg")
+
+
+# A fenced ```json block if the model used one, else the outermost braces
+json_pattern = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```|(\{.*\})", re.DOTALL)
+
+# The same for an array of objects, for requests covering several documents
+json_array_pattern = re.compile(
+    r"```(?:json)?\s*(\[\s*\{.*?\}\s*\])\s*```|(\[\s*\{.*\])", re.DOTALL
+)
+
+json_decoder = json.JSONDecoder()
+
+
+def parse_json(text, expect_array=False):
+    match = (json_array_pattern if expect_array else json_pattern).search(text)
+    if match is None:
+        raise orjson.JSONDecodeError("No JSON object found", text, 0)
+    value = match.group(1) or match.group(2)
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        # The unfenced match runs to the last brace, so a note after the JSON
+        # with braces of its own breaks it. The stdlib decoder stops at the end
+        # of the first complete value instead.
+        try:
+            return json_decoder.raw_decode(value)[0]
+        except json.JSONDecodeError:
+            pass
+        raise
+
+
+def response_text(response):
+    # Text is None when the response has no text parts, e.g. a safety block
+    if response.text is None:
+        raise ValueError("the model returned no text")
+    return response.text
+
+
+def is_parseable(text):
+    try:
+        parse_json(text)
+    except orjson.JSONDecodeError:
+        return False
+    return True
+
+
+@functools.cache
+def prompt_part(prompt):
+    # Each prompt is wrapped in a Part once, instead of on every request
+    return types.Part.from_text(text=prompt)
+
+
+@st.cache_resource
+def get_genai_client():
+    # One client per process, so its HTTP session is reused across reruns
+    return genai.Client(api_key=st.secrets["api_keys"]["google"])
+
+
+def retry_delay(error, attempt):
+    # Gemini says how long to wait in the RetryInfo detail of a 429
+    details = error.details if isinstance(error.details, dict) else {}
+    for detail in details.get("error", {}).get("details", []):
+        if detail.get("@type", "").endswith("RetryInfo"):
+            return float(detail["retryDelay"].rstrip("s"))
+    return 2**attempt
+
+
+async def with_retries(request):
+    # Calls request() again after a rate-limit error, waiting as Gemini asks
+    for attempt in range(max_retries):
+        try:
+            return await request()
+        except errors.ClientError as e:
+            if e.code != 429 or attempt == max_retries - 1:
+                raise
+            await asyncio.sleep(retry_delay(e, attempt))
+
+
+async def extract_info_from_image(prompt, image):
+    google_client = get_genai_client()
+    return await with_retries(
+        lambda: google_client.aio.models.generate_content(
+            model=gemini_model, contents=[prompt_part(prompt), image]
+        )
+    )
+
+
+async def extract_info_from_pdfs(prompt, pdfs):
+    google_client = get_genai_client()
+    contents = [
+        types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
+        for pdf_bytes in pdfs
+    ]
+    return await with_retries(
+        lambda: google_client.aio.models.generate_content(
+            model=gemini_model, contents=contents + [prompt_part(prompt)]
+        )
+    )
+
+
+@st.cache_data(show_spinner=False)
+def extract_pdfs_cached(pdfs, prompt=invoice_extraction_prompt):
+    # Keyed on the PDF bytes, so reruns don't send the same group again.
+    # Empty or unparseable output raises, so it is never cached.
+    text = response_text(run(extract_info_from_pdfs(prompt, pdfs)))
+    parse_json(text, expect_array=len(pdfs) > 1)
+    return text
+
+
+# The connection is shared by the script thread and the request workers, and
+# sqlite3 leaves serialising access to the caller
+db_lock = threading.Lock()
+
+
+@st.cache_resource
+def get_db():
+    # Extractions outlive the Streamlit cache, so reopening the app is free
+    con = sqlite3.connect("invoices.db", check_same_thread=False)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS extractions (hash BLOB PRIMARY KEY, text TEXT)"
+    )
+    return con
+
+
+def extraction_key(img_bytes, prompt=invoice_extraction_prompt):
+    # Hashed in two updates, so the upload isn't copied to prepend the prompt
+    h = hashlib.sha256(prompt.encode())
+    h.update(img_bytes)
+    return h.digest()
+
+
+def lookup_extraction(img_bytes, prompt=invoice_extraction_prompt):
+    key = extraction_key(img_bytes, prompt)
+    with db_lock:
+        row = (
+            get_db()
+            .execute("SELECT text FROM extractions WHERE hash = ?", (key,))
+            .fetchone()
+        )
+    if row is not None and is_parseable(row[0]):
+        return row[0]
+    return None
+
+
+def store_extraction(img_bytes, text, prompt=invoice_extraction_prompt):
+    key = extraction_key(img_bytes, prompt)
+    db = get_db()
+    with db_lock, db:
+        db.execute("INSERT OR REPLACE INTO extractions VALUES (?, ?)", (key, text))
+
+
+@st.cache_data(persist="disk", max_entries=500, show_spinner=False)
+def extract_cached(img_bytes, prompt=invoice_extraction_prompt):
+    # Keyed on the image bytes, so reruns and re-uploads skip the model call
+    text = lookup_extraction(img_bytes, prompt)
+    if text is not None:
+        return text
+
+    response = run(extract_info_from_image(prompt, image_part(img_bytes)))
+    # Empty or malformed output raises here, so it is neither stored nor cached
+    # and the next run asks the model again instead of replaying it
+    text = response_text(response)
+    parse_json(text)
+    store_extraction(img_bytes, text, prompt)
+    return text
@@ -1,15 +1,26 @@
 import streamlit as st
-from PIL import Image
 import pandas as pd
-import json
-import asyncio
-from google import genai
-import tempfile
-import os
-from pypdf import PdfReader
-import fitz  # PyMuPDF
-import pathlib
+import orjson
+import hashlib
+import concurrent.futures
 from google.genai import types
+from invoice_core import (
+    decode,
+    extract_cached,
+    extract_pdfs_cached,
+    extraction_key,
+    gemini_model,
+    get_genai_client,
+    image_part,
+    is_parseable,
+    lookup_extraction,
+    parse_json,
+    pdf_to_text_and_images,
+    prompt_part,
+    response_text,
+    show_pdf_preview,
+    store_extraction,
+)
 
 # Set page config
 st.set_page_config(page_title="Invoice Extractor", layout="wide")
@@ -42,42 +53,148 @@ Expected JSON response:
 }
 """
 
+# Prompt for several PDFs sent in one request
+invoice_group_extraction_prompt = invoice_extraction_prompt + """
+Several invoice documents are attached, one invoice per document. Return a JSON array with one object in the format above for each document, in the order the documents are attached.
+"""
 
-def pdf_to_images(path):
-    images = []
-    with fitz.open(path) as pdf:
-        for page in pdf:
-            pix = page.get_pixmap(dpi=150)  # higher DPI = better quality
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            images.append(img)
-    return images
+# PDFs sent to Gemini together in one request
+pdf_group_size = 5
 
 
-# Load Google API key from Streamlit secrets
-google_api_key = st.secrets["api_keys"]["google"]
+def parse_response(text, expect_array=False):
+    # The parsed model output, or the error that stopped the request; an
+    # unparseable response only fails its own files
+    if isinstance(text, Exception):
+        return text
+    try:
+        return parse_json(text, expect_array)
+    except orjson.JSONDecodeError as e:
+        return e
 
 
-async def extract_info_from_pdf(prompt, pdf_path):
-    google_client = genai.Client(api_key=google_api_key)
-    response = google_client.models.generate_content(
-        model="gemini-2.0-flash-lite",
-        contents=[
-            types.Part.from_bytes(
-                data=pdf_path.read_bytes(),
-                mime_type="application/pdf",
-            ),
-            prompt,
-        ],
-    )
-    return response
+# Above this many images a Gemini batch job is used instead of live requests
+batch_threshold = 20
+
+# Batch job states after which no more results will arrive
+batch_done_states = {
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+}
 
 
-async def extract_info_from_image(prompt, image):
-    google_client = genai.Client(api_key=google_api_key)
-    response = google_client.models.generate_content(
-        model="gemini-2.0-flash-lite", contents=[prompt] + image
+def batch_results(prompt, images, job_key):
+    # The job is created once and its name kept in the session, so polls and
+    # reruns resume it instead of paying for a new one; once finished, its
+    # results take the name's place. Returns None while the job is running.
+    job_name = st.session_state.get(job_key)
+    if isinstance(job_name, list):
+        return job_name
+    google_client = get_genai_client()
+    if job_name is None:
+        batch_job = google_client.batches.create(
+            model=gemini_model,
+            src=[
+                types.InlinedRequest(
+                    contents=[prompt_part(prompt), image_part(img_bytes)]
+                )
+                for img_bytes in images
+            ],
+        )
+        st.session_state[job_key] = batch_job.name
+    else:
+        batch_job = google_client.batches.get(name=job_name)
+    if batch_job.state not in batch_done_states:
+        return None
+
+    if batch_job.state not in (
+        types.JobState.JOB_STATE_SUCCEEDED,
+        types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+    ):
+        error = RuntimeError(f"Batch job finished with state {batch_job.state}")
+        results = [error] * len(images)
+    else:
+        # One text or exception per image, like the live requests
+        results = []
+        for item in batch_job.dest.inlined_responses or []:
+            try:
+                if item.error is not None:
+                    raise RuntimeError(item.error.message)
+                results.append(response_text(item.response))
+            except Exception as e:
+                results.append(e)
+        if len(results) != len(images):
+            # Images the job returned no response for are reported, not dropped
+            error = RuntimeError("the batch job returned no response for this image")
+            results = results[: len(images)]
+            results += [error] * (len(images) - len(results))
+    # Stored like the live extractions, so later runs skip these images
+    for img_bytes, text in zip(images, results):
+        if isinstance(text, str) and is_parseable(text):
+            store_extraction(img_bytes, text, prompt)
+    st.session_state[job_key] = results
+    return results
+
+
+def show_results(results, filenames):
+    # An error per failed file, then one row per extracted invoice
+    extracted = []
+    for idx in sorted(results):
+        filename = filenames[idx]
+        result = results[idx]
+        if isinstance(result, orjson.JSONDecodeError):
+            st.error(f"Could not parse valid JSON from model output for {filename}.")
+        elif isinstance(result, Exception):
+            st.error(f"Model failed to extract info from {filename}: {result}")
+        else:
+            extracted.append((filename, result))
+
+    if extracted:
+        # Create a container with increased height
+        with st.container(height=1600):
+            # Built in a single pass, indexed by filename; a list rather than a
+            # dict keyed by filename, so files with the same name all show
+            combined_df = pd.DataFrame.from_records(
+                [data for _, data in extracted],
+                index=[filename for filename, _ in extracted],
+            )
+            st.dataframe(combined_df, use_container_width=True)
+
+
+@st.fragment(run_every=10)
+def batch_panel(batch_images, filenames):
+    # Polls the batch job on its own timer, so waiting on it reruns only this
+    # panel rather than every upload, preview and request in the app. The job
+    # is keyed on the images it was created for.
+    job_key = (
+        "batch_job_"
+        + hashlib.sha256(
+            b"".join(
+                extraction_key(img_bytes, invoice_extraction_prompt)
+                for _, img_bytes in batch_images
+            )
+        ).hexdigest()
     )
-    return response
+    try:
+        batch_responses = batch_results(
+            invoice_extraction_prompt,
+            [img_bytes for _, img_bytes in batch_images],
+            job_key,
+        )
+    except Exception as e:
+        batch_responses = [e] * len(batch_images)
+    if batch_responses is None:
+        st.info(f"Waiting for Gemini batch job {st.session_state[job_key]}...")
+        return
+
+    results = {
+        idx: parse_response(response)
+        for (idx, _), response in zip(batch_images, batch_responses)
+    }
+    show_results(results, filenames)
 
 
 # Sidebar: Upload image
@@ -87,127 +204,130 @@ uploaded_files = st.sidebar.file_uploader(
     type=["png", "jpg", "jpeg", "pdf"],
     accept_multiple_files=True,
 )
+max_concurrent = st.sidebar.number_input(
+    "Max concurrent requests", 1, 20, 5, key="max_concurrent"
+)
 
 if len(uploaded_files) > 0:
     # Display layout
     col1, col2 = st.columns([1, 2])
 
-    # Store all extracted data
-    all_extracted_data = []
-
     with col1:
         st.subheader("Document Preview")
 
     with col2:
         st.subheader("Extracted Invoice Data")
 
-    # Process each file
-    for uploaded_file in uploaded_files:
-        # Create a temporary file to store the uploaded file
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=os.path.splitext(uploaded_file.name)[1]
-        ) as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
-
-        try:
-            # Handle PDF files
-            if uploaded_file.type == "application/pdf":
-                # Extract text from PDF
-                pdf_reader = PdfReader(tmp_file_path)
-                text_content = ""
-                # Get text from first page only
-                if len(pdf_reader.pages) > 0:
-                    text_content = pdf_reader.pages[0].extract_text()
-                    images = pdf_to_images(tmp_file_path)
-
-                with col1:
-                    st.write(f"**PDF: {uploaded_file.name}**")
-                    for img in images:
-                        st.image(img, use_container_width=True)
-
-                # Send to Gemini
-                with st.spinner(f"Extracting data from {uploaded_file.name}..."):
-                    try:
-                        response = asyncio.run(
-                            extract_info_from_pdf(
-                                invoice_extraction_prompt, pathlib.Path(tmp_file_path)
-                            )
-                        )
-                        info_text = response.text
-
-                        try:
-                            json_start = info_text.find("{")
-                            json_end = info_text.rfind("}") + 1
-                            info_formatted = json.loads(info_text[json_start:json_end])
-                            all_extracted_data.append(
-                                {"filename": uploaded_file.name, "data": info_formatted}
-                            )
-
-                        except json.JSONDecodeError:
-                            st.error(
-                                f"Could not parse valid JSON from model output for {uploaded_file.name}."
-                            )
-                    except Exception as e:
-                        st.error(
-                            f"Model failed to extract info from {uploaded_file.name}: {e}"
-                        )
-
-            else:
-                # Handle regular image files
-                image = Image.open(uploaded_file)
-
-                with col1:
-                    st.write(f"**Image: {uploaded_file.name}**")
-                    st.image(image, use_container_width=True)
-
-                # Send to Gemini
-                with st.spinner(f"Extracting data from {uploaded_file.name}..."):
-                    try:
-                        response = asyncio.run(
-                            extract_info_from_image(invoice_extraction_prompt, [image])
-                        )
-                        info_text = response.text
-
-                        try:
-                            json_start = info_text.find("{")
-                            json_end = info_text.rfind("}") + 1
-                            info_formatted = json.loads(info_text[json_start:json_end])
-                            all_extracted_data.append(
-                                {"filename": uploaded_file.name, "data": info_formatted}
-                            )
-
-                        except json.JSONDecodeError:
-                            st.error(
-                                f"Could not parse valid JSON from model output for {uploaded_file.name}."
-                            )
-                    except Exception as e:
-                        st.error(
-                            f"Model failed to extract info from {uploaded_file.name}: {e}"
-                        )
-
-        finally:
-            # Clean up temporary file
-            if os.path.exists(tmp_file_path):
-                os.unlink(tmp_file_path)
-
-    # Display all extracted data in a tabbed interface
-    if all_extracted_data:
-        with col2:
-            # Create a container with increased height
-            with st.container(height=1600):  # Increased height to 800 pixels
-                # Create a list to store all DataFrames
-                dfs = []
-                for data in all_extracted_data:
-                    # Create DataFrame and transpose it
-                    df = pd.DataFrame(
-                        data["data"].items(), columns=["Field", data["filename"]]
-                    )
-                    df.set_index("Field", inplace=True)
-                    dfs.append(df)
-
-                # Concatenate all DataFrames horizontally
-                combined_df = pd.concat(dfs, axis=1)
-
-                # Display the combined DataFrame
-                st.dataframe(combined_df.transpose(), use_container_width=True)
+    # Every request is dispatched before any result is awaited, so all files
+    # are extracted concurrently while the previews below are rendered
+    pending_images = [
+        (idx, uploaded_file.getvalue())
+        for idx, uploaded_file in enumerate(uploaded_files)
+        if uploaded_file.type != "application/pdf"
+    ]
+    # Only images not already in the database count towards a batch job
+    batch_images = [
+        (idx, img_bytes)
+        for idx, img_bytes in pending_images
+        if lookup_extraction(img_bytes, invoice_extraction_prompt) is None
+    ]
+    if len(batch_images) <= batch_threshold:
+        batch_images = []
+    batch_idxs = {idx for idx, _ in batch_images}
+
+    # Images and PDFs share one limit of max_concurrent requests in flight:
+    # each worker waits on one request at a time on the shared event loop
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent)
+    requests = {}
+    # Through the SQLite-backed cache, so reruns skip images already done
+    for idx, img_bytes in pending_images:
+        if idx not in batch_idxs:
+            requests[idx] = pool.submit(
+                extract_cached, img_bytes, invoice_extraction_prompt
+            )
+
+    # PDFs are sent in groups of pdf_group_size, each group as soon as it fills
+    pending_pdfs = []
+    pdf_requests = []
+
+    def submit_pdfs():
+        # A lone PDF is asked for a single object, like the images
+        idxs, pdfs = zip(*pending_pdfs)
+        prompt = invoice_group_extraction_prompt
+        if len(pdfs) == 1:
+            prompt = invoice_extraction_prompt
+        request = pool.submit(extract_pdfs_cached, pdfs, prompt)
+        pdf_requests.append((idxs, request))
+        pending_pdfs.clear()
+
+    for idx, uploaded_file in enumerate(uploaded_files):
+        # Handle PDF files
+        if uploaded_file.type == "application/pdf":
+            pdf_bytes = uploaded_file.getvalue()
+            pending_pdfs.append((idx, pdf_bytes))
+            if len(pending_pdfs) == pdf_group_size:
+                submit_pdfs()
+
+            # First-page text, and a preview of every page unless scanned
+            text_content, images = pdf_to_text_and_images(pdf_bytes)
+
+            with col1:
+                st.write(f"**PDF: {uploaded_file.name}**")
+                show_pdf_preview(text_content, images)
+
+        else:
+            # Handle regular image files
+            image = decode(uploaded_file.getvalue())
+
+            with col1:
+                st.write(f"**Image: {uploaded_file.name}**")
+                st.image(image, use_container_width=True, output_format="JPEG")
+
+    if pending_pdfs:
+        submit_pdfs()
+    pool.shutdown(wait=False)
+
+    # One progress update per finished request instead of a spinner each
+    all_requests = list(requests.values()) + [request for _, request in pdf_requests]
+    if all_requests:
+        progress = st.progress(0.0)
+        completed = concurrent.futures.as_completed(all_requests)
+        for done, _ in enumerate(completed, 1):
+            progress.progress(
+                done / len(all_requests),
+                text=f"Completed {done} of {len(all_requests)} requests",
+            )
+        progress.empty()
+
+    responses = {
+        idx: request.exception() or request.result()
+        for idx, request in requests.items()
+    }
+
+    # Every file's parsed invoice, or the error that stopped it
+    results = {idx: parse_response(response) for idx, response in responses.items()}
+
+    # A PDF group's response holds one invoice per document, in order
+    for idxs, request in pdf_requests:
+        invoices = parse_response(
+            request.exception() or request.result(), expect_array=len(idxs) > 1
+        )
+        if isinstance(invoices, dict):
+            invoices = [invoices]
+        if isinstance(invoices, list) and (
+            len(invoices) != len(idxs)
+            or not all(isinstance(invoice, dict) for invoice in invoices)
+        ):
+            invoices = ValueError(f"expected {len(idxs)} invoices in the response")
+        if isinstance(invoices, Exception):
+            results.update(dict.fromkeys(idxs, invoices))
+        else:
+            results.update(zip(idxs, invoices))
+
+    filenames = [uploaded_file.name for uploaded_file in uploaded_files]
+    with col2:
+        show_results(results, filenames)
+
+        # Large image sets go through a batch job instead of live requests
+        if batch_images:
+            batch_panel(batch_images, filenames)